@@ -29,9 +29,34 @@ class FHEServer:
         Returns:
             bytes: The filter's output.
         """
-        # Deserialize the encrypted input image and the evaluation keys
+        # Deserialize the evaluation keys
+        evaluation_keys = self.deserialize_evaluation_keys(serialized_evaluation_keys)
+
+        return self.run_with_evaluation_keys(serialized_encrypted_image, evaluation_keys)
+
+    def deserialize_evaluation_keys(self, serialized_evaluation_keys):
+        """Deserialize the evaluation keys, in order to run the filter on several images.
+
+        Args:
+            serialized_evaluation_keys (bytes): The serialized evaluation keys.
+
+        Returns:
+            fhe.EvaluationKeys: The evaluation keys.
+        """
+        return fhe.EvaluationKeys.deserialize(serialized_evaluation_keys)
+
+    def run_with_evaluation_keys(self, serialized_encrypted_image, evaluation_keys):
+        """Run the filter on the server over an encrypted image, using deserialized evaluation keys.
+
+        Args:
+            serialized_encrypted_image (bytes): The encrypted and serialized image.
+            evaluation_keys (fhe.EvaluationKeys): The evaluation keys.
+
+        Returns:
+            bytes: The filter's output.
+        """
+        # Deserialize the encrypted input image
         encrypted_image = fhe.Value.deserialize(serialized_encrypted_image)
-        evaluation_keys = fhe.EvaluationKeys.deserialize(serialized_evaluation_keys)
 
         # Execute the filter in FHE
         encrypted_output = self.server.run(encrypted_image, evaluation_keys=evaluation_keys)
@@ -1,7 +1,43 @@
 "All the constants used in this repo."
 
+import os
+import stat
+import tempfile
 from pathlib import Path
 
+def make_private_dir(path):
+    """Create a directory only accessible by the current user, or check that the existing one is.
+
+    A directory in a shared location, such as the system's temp directory, may have been created
+    beforehand by another user, who could then read or replace the files it contains.
+
+    Args:
+        path (pathlib.Path): The directory to create.
+
+    Raises:
+        PermissionError: If the directory already exists but belongs to another user, is writable by
+            other users or is not a directory.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.mkdir(mode=0o700, exist_ok=True)
+
+    # Owners are only available on POSIX platforms
+    if not hasattr(os, "getuid"):
+        return
+
+    # Symbolic links are not followed, as they may point to a directory of another user
+    path_stat = path.lstat()
+    if not stat.S_ISDIR(path_stat.st_mode) or path_stat.st_uid != os.getuid():
+        raise PermissionError(f"{path} must be a directory owned by the current user")
+
+    # Other users may already have added files to a directory they can write to
+    if path_stat.st_mode & 0o022:
+        raise PermissionError(f"{path} must not be writable by other users")
+
+    if path_stat.st_mode & 0o077:
+        path.chmod(0o700)
+
+
 # This repository's directory
 REPO_DIR = Path(__file__).parent
 
@@ -9,12 +45,17 @@ REPO_DIR = Path(__file__).parent
 FILTERS_PATH = REPO_DIR / "filters"
 KEYS_PATH = REPO_DIR / ".fhe_keys"
 CLIENT_TMP_PATH = REPO_DIR / "client_tmp"
-SERVER_TMP_PATH = REPO_DIR / "server_tmp"
+
+# The server's temporary files are large blobs that are only read back once, so they are kept out
+# of the repository's directory, which may sit on a slow or mounted disk. Set FHE_TMPDIR to a
+# RAM-backed directory (e.g., /dev/shm/fhe) to avoid any disk I/O. As they include the users'
+# evaluation keys, they are only accessible by the user running the server
+SERVER_TMP_PATH = Path(os.environ.get("FHE_TMPDIR", tempfile.gettempdir())) / "fhe_server"
 
 # Create the necessary folders
 KEYS_PATH.mkdir(exist_ok=True)
 CLIENT_TMP_PATH.mkdir(exist_ok=True)
-SERVER_TMP_PATH.mkdir(exist_ok=True)
+make_private_dir(SERVER_TMP_PATH)
 
 # All the filters currently available in the demo
 AVAILABLE_FILTERS = [
@@ -1,21 +1,291 @@
 """Server that will listen for GET and POST requests from the client."""
 
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
 import time
-from typing import List
-from fastapi import FastAPI, File, Form, UploadFile
-from fastapi.responses import JSONResponse, Response
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from multiprocessing import shared_memory
+from pathlib import Path
+from typing import Annotated, Literal
+from uuid import UUID
 
-from common import FILTERS_PATH, SERVER_TMP_PATH, AVAILABLE_FILTERS, CLIENT_TMP_PATH
+import blake3
+import diskcache
+import rapfiles as aiof
+import zstandard
+from cachetools import LRUCache
+from fastapi import FastAPI, Form, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import FileResponse, JSONResponse, Response
+from python_multipart import MultipartParser
+from python_multipart.exceptions import MultipartParseError
+from pydantic import UUID4, BaseModel, ConfigDict, ValidationError
+from python_multipart.multipart import MultipartState, parse_options_header
+from starlette.datastructures import Headers, MutableHeaders
+
+from common import (
+    FILTERS_PATH,
+    SERVER_TMP_PATH,
+    AVAILABLE_FILTERS,
+    CLIENT_TMP_PATH,
+    make_private_dir,
+)
 from client_server_interface import FHEServer
 
-# Load the server objects related to all currently available filters once and for all
-FHE_SERVERS = {
-    filter: FHEServer(FILTERS_PATH / f"{filter}/deployment") for filter in AVAILABLE_FILTERS
-}
+logger = logging.getLogger(__name__)
+
+# The server objects related to all currently available filters, only loaded in the worker
+# processes executing the FHE computations
+FHE_SERVERS = {}
+
+# The number of server processes handling the requests. Running this script sets it for all the
+# server processes (one per CPU by default), while other launchers (e.g., Gunicorn) have to set it
+# to their number of workers, a single server process being assumed otherwise
+SERVER_WORKERS = int(os.environ.get("FHE_SERVER_WORKERS", 1))
+
+# The number of worker processes executing FHE computations in parallel, for each server process
+FHE_WORKERS = int(os.environ.get("FHE_WORKERS", max(1, os.cpu_count() // SERVER_WORKERS)))
+
+# The pool of worker processes executing FHE computations, started along with the server
+FHE_EXECUTOR = None
+
+# The filters whose FHE execution is deterministic, meaning that an encrypted input image always
+# gives the same encrypted output image. This is the case of all the current filters, as their
+# circuits do not involve any randomness
+DETERMINISTIC_FILTERS = frozenset(AVAILABLE_FILTERS)
+
+# Keep the encrypted outputs of deterministic filters on disk, so that an encrypted input image sent
+# again does not need to be processed again. The cache is shared by all the server processes and
+# opened along with the server. It is kept apart from the server's temporary files by default, as
+# these may be stored in RAM, in the user's own cache directory. As the cache unpickles what it
+# reads, its directory is only accessible by the user running the server
+RUN_CACHE_PATH = Path(
+    os.environ.get(
+        "FHE_RUN_CACHE_DIR",
+        Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "fhe_server" / "run_cache",
+    )
+)
+RUN_CACHE_SIZE = int(os.environ.get("FHE_RUN_CACHE_SIZE", 10 * 1024**3))
+RUN_CACHE = None
+
+# The time (in seconds) after which the batching of a user's FHE executions for a filter stops when
+# no new execution comes in
+BATCH_IDLE_TIMEOUT = float(os.environ.get("FHE_BATCH_IDLE_TIMEOUT", 30))
+
+# Evaluation keys are sent to the worker processes through shared memory, which is backed by this
+# directory on Linux
+SHARED_MEMORY_PATH = Path("/dev/shm")
+
+# The available filters never change while the server runs, so their ETag is computed once
+AVAILABLE_FILTERS_ETAG = f'"{hashlib.sha256(json.dumps(AVAILABLE_FILTERS).encode()).hexdigest()}"'
+
+# Keep the most recently used evaluation keys in memory, as they are tied to a user rather than to
+# a computation. The cache is bounded by the keys' total size (in bytes) rather than their number,
+# which is split evenly across the server processes. Each entry is stored along with the version of
+# the key file it was read from and the time (in nanoseconds) it was cached at
+EVALUATION_KEYS_CACHE_SIZE = (
+    int(os.environ.get("FHE_KEYS_CACHE_SIZE", 2 * 1024**3)) // SERVER_WORKERS
+)
+EVALUATION_KEYS_CACHE = LRUCache(
+    maxsize=EVALUATION_KEYS_CACHE_SIZE, getsizeof=lambda entry: len(entry[1])
+)
+
+# Evicting a user's keys is requested from a single server process, which leaves a marker file
+# behind so that the other server processes evict them as well when they next check (every few
+# seconds). Markers are removed once all the server processes have had time to see them
+EVICTION_MARKERS_PATH = SERVER_TMP_PATH / "evictions"
+EVICTION_CHECK_INTERVAL = 5
+EVICTION_MARKERS_TTL = 60
+
+# The zstd compression level of the responses, kept low so that compressing them stays cheap, and
+# the size (in bytes) under which responses are not worth compressing
+ZSTD_LEVEL = int(os.environ.get("FHE_ZSTD_LEVEL", 1))
+ZSTD_MINIMUM_SIZE = 500
+
+# The limits of zstd-encoded requests: the decompressed body's size (in bytes), as a small body can
+# decompress to gigabytes, and the decompression window, which bounds the memory it needs. 8 MiB is
+# the window size all zstd decoders are expected to support
+ZSTD_MAX_DECOMPRESSED_SIZE = int(os.environ.get("FHE_MAX_DECOMPRESSED_SIZE", 1024**3))
+ZSTD_MAX_WINDOW_SIZE = 8 * 1024**2
+
+# The largest size ratio between decompressed and compressed zstd data, reached by 4-byte blocks
+# repeating a byte 128 KiB times
+ZSTD_MAX_RATIO = 2**15
+
+
+class FHERequest(BaseModel):
+    """Form fields identifying the user and the filter of an FHE computation.
+
+    Validating them upfront rejects malformed user IDs, which are used in file paths, and unknown
+    filters before they reach the FHE execution.
+    """
+
+    model_config = ConfigDict(frozen=True)
+
+    user_id: UUID4
+    filter: Literal[tuple(AVAILABLE_FILTERS)]
+
+
+class FHEFullRequest(FHERequest):
+    """Form fields of a complete FHE computation request."""
+
+    # Whether to keep the inputs and the output on disk for /run_fhe and /get_output
+    persist: bool = False
+
+
+def prefetch_deployment_files():
+    """Ask the kernel to read the filters' deployment files ahead of time.
+
+    The worker processes then load their FHE servers from the page cache rather than the disk.
+    """
+    # Advising the kernel is only available on some platforms (e.g., Linux)
+    if not hasattr(os, "posix_fadvise"):
+        return
+
+    for filter in AVAILABLE_FILTERS:
+        for path in (FILTERS_PATH / f"{filter}/deployment").glob("*"):
+            if path.is_file():
+                with path.open("rb") as file:
+                    os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+
+
+def load_fhe_servers():
+    """Load the server objects related to all currently available filters once and for all.
+
+    This is the initializer of the worker processes executing the FHE computations.
+    """
+    for filter in AVAILABLE_FILTERS:
+        FHE_SERVERS[filter] = FHEServer(FILTERS_PATH / f"{filter}/deployment")
+
+
+def read_shared_evaluation_key(evaluation_key):
+    """Read an evaluation key shared by the server process, in a worker process.
+
+    Args:
+        evaluation_key (Union[Tuple[str, int], bytes]): The name and size of the shared memory
+            segment holding the serialized evaluation key, or the serialized evaluation key itself.
+
+    Returns:
+        bytes: The serialized evaluation key.
+    """
+    if isinstance(evaluation_key, bytes):
+        return evaluation_key
+
+    name, size = evaluation_key
+    segment = shared_memory.SharedMemory(name=name)
+    try:
+        return bytes(segment.buf[:size])
+    finally:
+        segment.close()
+
+
+def run_fhe_server_batch(filter_name, encrypted_images, evaluation_key):
+    """Run the FHE server related to the chosen filter on several images, in a worker process.
+
+    The images share the same evaluation key, which is therefore only deserialized once.
+
+    Args:
+        filter_name (str): The filter chosen by the user.
+        encrypted_images (List[bytes]): The encrypted and serialized input images.
+        evaluation_key (Union[Tuple[str, int], bytes]): The name and size of the shared memory
+            segment holding the serialized evaluation key, or the serialized evaluation key itself.
+
+    Returns:
+        List[Union[Tuple[bytes, float], Exception]]: For each image, the encrypted and serialized
+            output image along with its FHE execution time (in seconds), or the error raised while
+            processing it.
+    """
+    fhe_server = FHE_SERVERS[filter_name]
+    evaluation_keys = fhe_server.deserialize_evaluation_keys(
+        read_shared_evaluation_key(evaluation_key)
+    )
+
+    results = []
+    for encrypted_image in encrypted_images:
+        # A malformed image must not fail the other images of the batch
+        try:
+            start = time.time()
+            encrypted_output_image = fhe_server.run_with_evaluation_keys(
+                encrypted_image, evaluation_keys
+            )
+            results.append((encrypted_output_image, round(time.time() - start, 2)))
+        except Exception as error:
+            results.append(error)
 
+    return results
+
+
+def get_worker_pid():
+    """Get the worker process' ID, only used for starting the worker processes ahead of time.
+
+    Returns:
+        int: The worker process' ID.
+    """
+    return os.getpid()
+
+
+def create_fhe_executor():
+    """Create the pool of worker processes executing FHE computations.
+
+    The worker processes are spawned rather than forked as the FHE library and the event loop both
+    run their own threads.
+
+    Returns:
+        ProcessPoolExecutor: The pool of worker processes.
+    """
+    return ProcessPoolExecutor(
+        max_workers=FHE_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=load_fhe_servers,
+    )
+
+
+async def run_in_fhe_executor(func, *args):
+    """Run a function in a worker process, replacing the pool of worker processes if it broke.
+
+    A worker process dying (e.g., killed when running out of memory) breaks the whole pool, which
+    then rejects all the following tasks. The pool is therefore replaced, and the function run
+    again once.
+
+    Args:
+        func (Callable): The function to run.
+        *args: The function's arguments.
+
+    Returns:
+        Any: The function's result.
+    """
+    global FHE_EXECUTOR
+
+    loop = asyncio.get_running_loop()
+    for attempt in range(2):
+        executor = FHE_EXECUTOR
+        try:
+            return await loop.run_in_executor(executor, func, *args)
+        except BrokenProcessPool:
+            # Concurrent tasks may all fail on the same broken pool, which is only replaced once
+            if FHE_EXECUTOR is executor:
+                logger.warning("A worker process died, restarting the worker processes")
+                FHE_EXECUTOR = create_fhe_executor()
+                executor.shutdown(wait=False, cancel_futures=True)
+            if attempt:
+                raise
+
+
+@functools.lru_cache(maxsize=4096)
 def get_server_file_path(name, user_id, filter_name):
     """Get the correct temporary file path for the server.
 
+    The paths are cached, as the same ones are computed for every request of a user.
+
     Args:
         name (str): The desired file name.
         user_id (int): The current user's ID.
@@ -27,8 +297,836 @@ def get_server_file_path(name, user_id, filter_name):
     return SERVER_TMP_PATH / f"{name}_{filter_name}_{user_id}"
 
 
+def get_file_version(path):
+    """Get a file's version, which changes whenever the file is replaced or modified.
+
+    Args:
+        path (pathlib.Path): The file to consider.
+
+    Returns:
+        Tuple[int, int]: The file's modification time (in nanoseconds) and size.
+    """
+    stat = path.stat()
+    return stat.st_mtime_ns, stat.st_size
+
+
+def get_digest(data):
+    """Hash an encrypted image or an evaluation key.
+
+    They can weigh hundreds of megabytes, so they are hashed with BLAKE3, which is much faster than
+    SHA-2 on large inputs. The hash still needs to be cryptographic, as they are sent by the users:
+    a non-cryptographic hash would let one craft an image colliding with another user's and
+    retrieve their cached output.
+
+    Args:
+        data (bytes): The encrypted and serialized image or the serialized evaluation key.
+
+    Returns:
+        str: The data's digest.
+    """
+    return blake3.blake3(data, max_threads=blake3.blake3.AUTO).hexdigest()
+
+
+def create_shared_segment(evaluation_key):
+    """Copy an evaluation key into a new shared memory segment.
+
+    Args:
+        evaluation_key (bytes): The serialized evaluation key.
+
+    Returns:
+        shared_memory.SharedMemory: The shared memory segment.
+    """
+    segment = shared_memory.SharedMemory(create=True, size=max(1, len(evaluation_key)))
+    segment.buf[: len(evaluation_key)] = evaluation_key
+    return segment
+
+
+class SharedEvaluationKeys:
+    """Evaluation keys shared with the worker processes through shared memory.
+
+    Passing an evaluation key as a task argument pickles it through the pool's pipe and unpickles
+    it in the worker process, for every batch. Instead, each key is copied once into a shared
+    memory segment, which the worker processes read directly. A segment is kept while batches use
+    it, and for the idle timeout afterwards so that the user's next batches reuse it.
+    """
+
+    def __init__(self, idle_timeout):
+        """Initialize the shared evaluation keys.
+
+        Args:
+            idle_timeout (float): The time (in seconds) after which an unused segment is removed.
+        """
+        self.idle_timeout = idle_timeout
+
+        # The segments, their number of batches using them and their removal timer, by key digest
+        self.entries = {}
+
+    async def acquire(self, key_digest, evaluation_key):
+        """Share an evaluation key with the worker processes, until it is released.
+
+        Args:
+            key_digest (str): The evaluation key's digest.
+            evaluation_key (bytes): The serialized evaluation key.
+
+        Returns:
+            Union[Tuple[str, int], bytes]: The name and size of the shared memory segment holding
+                the evaluation key, or the evaluation key itself if shared memory is running out.
+        """
+        entry = self.entries.get(key_digest)
+
+        if entry is None:
+            # Shared memory is often small in containers, and writing past its capacity kills the
+            # process, so the key is passed as is if it does not fit
+            if (
+                SHARED_MEMORY_PATH.is_dir()
+                and shutil.disk_usage(SHARED_MEMORY_PATH).free < len(evaluation_key)
+            ):
+                return evaluation_key
+
+            # Copying a large key would block the event loop
+            segment = await asyncio.to_thread(create_shared_segment, evaluation_key)
+
+            # The same key may have been shared in the meantime
+            entry = self.entries.get(key_digest)
+            if entry is None:
+                entry = self.entries[key_digest] = {"segment": segment, "users": 0, "timer": None}
+            else:
+                segment.close()
+                segment.unlink()
+
+        if entry["timer"] is not None:
+            entry["timer"].cancel()
+            entry["timer"] = None
+
+        entry["users"] += 1
+        return entry["segment"].name, len(evaluation_key)
+
+    def release(self, key_digest, shared_key):
+        """Stop using a shared evaluation key, removing it after the idle timeout if unused.
+
+        Args:
+            key_digest (str): The evaluation key's digest.
+            shared_key (Union[Tuple[str, int], bytes]): What acquiring the evaluation key returned.
+        """
+        # The key was passed as is
+        if isinstance(shared_key, bytes):
+            return
+
+        entry = self.entries[key_digest]
+        entry["users"] -= 1
+        if entry["users"] == 0:
+            entry["timer"] = asyncio.get_running_loop().call_later(
+                self.idle_timeout, self._remove, key_digest
+            )
+
+    def _remove(self, key_digest):
+        """Remove a shared evaluation key.
+
+        Args:
+            key_digest (str): The evaluation key's digest.
+        """
+        segment = self.entries.pop(key_digest)["segment"]
+        segment.close()
+        segment.unlink()
+
+    def close(self):
+        """Remove all the shared evaluation keys."""
+        for key_digest, entry in list(self.entries.items()):
+            if entry["timer"] is not None:
+                entry["timer"].cancel()
+            self._remove(key_digest)
+
+
+class FHEBatcher:
+    """Batch the concurrent FHE executions of a user for a filter.
+
+    Executions are queued per user and filter, and a single task per queue runs all the executions
+    queued so far in one go in a worker process. The evaluation key is then sent to the worker
+    process and deserialized once per batch rather than once per execution. The task stops once no
+    execution has been queued for the idle timeout.
+
+    Evaluation keys are passed to the worker processes through shared memory.
+    """
+
+    def __init__(self, idle_timeout):
+        """Initialize the batcher.
+
+        Args:
+            idle_timeout (float): The time (in seconds) after which an idle queue is dropped.
+        """
+        self.idle_timeout = idle_timeout
+        self.queues = {}
+        self.tasks = {}
+
+    async def run(self, user_id, filter_name, encrypted_image, evaluation_key, key_digest):
+        """Queue an FHE execution and wait for its output.
+
+        Args:
+            user_id (UUID4): The current user's ID.
+            filter_name (str): The filter chosen by the user.
+            encrypted_image (bytes): The encrypted and serialized input image.
+            evaluation_key (bytes): The serialized evaluation key.
+            key_digest (str): The evaluation key's digest.
+
+        Returns:
+            Tuple[bytes, float]: The encrypted and serialized output image and the FHE execution
+                time, in seconds.
+        """
+        key = (user_id, filter_name)
+        if key not in self.queues:
+            self.queues[key] = asyncio.Queue()
+            self.tasks[key] = asyncio.create_task(self._process(key))
+
+        future = asyncio.get_running_loop().create_future()
+        self.queues[key].put_nowait((encrypted_image, evaluation_key, key_digest, future))
+        return await future
+
+    async def _process(self, key):
+        """Run the executions queued for a user and a filter, in batches.
+
+        Args:
+            key (Tuple[UUID4, str]): The user's ID and the filter.
+        """
+        queue = self.queues[key]
+
+        while True:
+            try:
+                items = [await asyncio.wait_for(queue.get(), self.idle_timeout)]
+            except TimeoutError:
+                # Nothing can be queued in between, as no other task runs until this one awaits
+                if queue.empty():
+                    del self.queues[key], self.tasks[key]
+                    return
+                continue
+
+            while not queue.empty():
+                items.append(queue.get_nowait())
+
+            # The user may have sent a new evaluation key in the meantime, so the executions are
+            # grouped by evaluation key, keeping their order. Keys are compared by their digest, as
+            # comparing their content would block the event loop
+            batches = {}
+            for encrypted_image, evaluation_key, key_digest, future in items:
+                batches.setdefault(key_digest, (evaluation_key, []))[1].append(
+                    (encrypted_image, future)
+                )
+
+            for key_digest, (evaluation_key, batch) in batches.items():
+                encrypted_images, futures = zip(*batch)
+                try:
+                    shared_key = await SHARED_EVALUATION_KEYS.acquire(key_digest, evaluation_key)
+                    try:
+                        results = await run_in_fhe_executor(
+                            run_fhe_server_batch, key[1], encrypted_images, shared_key
+                        )
+                    finally:
+                        SHARED_EVALUATION_KEYS.release(key_digest, shared_key)
+                except Exception as error:
+                    results = [error] * len(futures)
+
+                for future, result in zip(futures, results):
+                    # The request may have been cancelled (e.g., the client disconnected)
+                    if future.done():
+                        continue
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+
+    async def close(self):
+        """Stop all the batching tasks."""
+        for task in self.tasks.values():
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+
+
+# The batcher of the FHE executions, shared by all the requests of the server process
+FHE_BATCHER = FHEBatcher(BATCH_IDLE_TIMEOUT)
+
+# The evaluation keys shared with the worker processes, kept as long as their user's batching
+SHARED_EVALUATION_KEYS = SharedEvaluationKeys(BATCH_IDLE_TIMEOUT)
+
+
+async def execute_fhe(user_id, filter_name, encrypted_image, evaluation_key):
+    """Execute the filter on the encrypted input image, unless its output has been cached.
+
+    Args:
+        user_id (UUID4): The current user's ID.
+        filter_name (str): The filter chosen by the user.
+        encrypted_image (bytes): The encrypted and serialized input image.
+        evaluation_key (bytes): The serialized evaluation key.
+
+    Returns:
+        Tuple[bytes, float]: The encrypted and serialized output image and the FHE execution time,
+            in seconds (0 if the output was cached).
+    """
+    cache_key = None
+
+    # Hashing the inputs and accessing the cache are both blocking, so they are done outside the
+    # event loop
+    key_digest = await asyncio.to_thread(get_digest, evaluation_key)
+
+    if filter_name in DETERMINISTIC_FILTERS:
+        # The evaluation key is part of the cache key, as the FHE library cannot tell whether an
+        # image is processed using the right evaluation key. The output computed using a wrong key
+        # must not be returned when the same image is sent again along with the right one
+        image_digest = await asyncio.to_thread(get_digest, encrypted_image)
+        cache_key = f"{image_digest}:{key_digest}:{filter_name}"
+        encrypted_output_image = await asyncio.to_thread(RUN_CACHE.get, cache_key)
+
+        if encrypted_output_image is not None:
+            return encrypted_output_image, 0.0
+
+    # Run the FHE execution in a worker process, as it is CPU-bound, batched with the other
+    # executions of the same user for the same filter
+    encrypted_output_image, fhe_execution_time = await FHE_BATCHER.run(
+        user_id, filter_name, encrypted_image, evaluation_key, key_digest
+    )
+
+    if cache_key is not None:
+        await asyncio.to_thread(RUN_CACHE.set, cache_key, encrypted_output_image)
+
+    return encrypted_output_image, fhe_execution_time
+
+
+def is_not_modified(request, etag):
+    """Check whether the client already holds the resource's current version.
+
+    Args:
+        request (Request): The incoming request.
+        etag (str): The resource's current ETag.
+
+    Returns:
+        bool: Whether the request's If-None-Match header matches the ETag.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+
+    etags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in etags or etag in etags
+
+
+def cache_evaluation_key(user_id, filter_name, evaluation_key, version):
+    """Keep a user's evaluation key in memory, unless it is too large to fit in the cache.
+
+    Args:
+        user_id (str): The current user's ID.
+        filter_name (str): The filter chosen by the user.
+        evaluation_key (bytes): The serialized evaluation key.
+        version (Tuple[int, int]): The version of the evaluation key's file.
+    """
+    if len(evaluation_key) <= EVALUATION_KEYS_CACHE.maxsize:
+        EVALUATION_KEYS_CACHE[user_id, filter_name] = (version, evaluation_key, time.time_ns())
+
+
+async def load_evaluation_key(user_id, filter_name):
+    """Load a user's evaluation key, from memory if it has been used recently.
+
+    Args:
+        user_id (str): The current user's ID.
+        filter_name (str): The filter chosen by the user.
+
+    Returns:
+        bytes: The serialized evaluation key.
+    """
+    evaluation_key_path = get_server_file_path("evaluation_key", user_id, filter_name)
+
+    # The key kept in memory is only used if its file has not been replaced since, as new keys can
+    # be sent to any of the server processes
+    version = get_file_version(evaluation_key_path)
+    cached_version, evaluation_key, _ = EVALUATION_KEYS_CACHE.get(
+        (user_id, filter_name), (None, None, None)
+    )
+
+    if cached_version != version:
+        evaluation_key = await aiof.read_file_bytes(str(evaluation_key_path))
+        cache_evaluation_key(user_id, filter_name, evaluation_key, version)
+
+    return evaluation_key
+
+
+def evict_marked_keys():
+    """Evict the keys of the users whose eviction was requested from any of the server processes.
+
+    Keys cached after the eviction was requested are kept, as they have been sent or used since.
+    """
+    now = time.time_ns()
+    for marker in os.scandir(EVICTION_MARKERS_PATH):
+        # Skip the markers removed in the meantime by another server process
+        try:
+            user_id = UUID(marker.name)
+            evicted_at = marker.stat().st_mtime_ns
+        except (ValueError, FileNotFoundError):
+            continue
+
+        for filter in AVAILABLE_FILTERS:
+            entry = EVALUATION_KEYS_CACHE.get((user_id, filter))
+            if entry is not None and entry[2] <= evicted_at:
+                del EVALUATION_KEYS_CACHE[user_id, filter]
+
+        if now - evicted_at > EVICTION_MARKERS_TTL * 10**9:
+            Path(marker.path).unlink(missing_ok=True)
+
+
+async def check_evictions():
+    """Periodically evict the keys whose eviction was requested from other server processes."""
+    while True:
+        await asyncio.sleep(EVICTION_CHECK_INTERVAL)
+
+        # Keep checking even if the markers cannot be read for now (e.g., their directory has
+        # been removed by a temp files cleaner)
+        try:
+            EVICTION_MARKERS_PATH.mkdir(exist_ok=True)
+            evict_marked_keys()
+        except Exception:
+            logger.exception("Failed to check the evaluation keys to evict")
+
+
+class StreamingFormParser:
+    """Multipart form parser handling the uploaded files as the request body streams in."""
+
+    def __init__(self, request, upload_dir=None):
+        """Initialize the parser.
+
+        Args:
+            request (Request): The incoming request, with a multipart/form-data body.
+            upload_dir (Path): The directory where the uploaded files are written. If None, the
+                uploaded files are kept in memory instead. Default to None.
+        """
+        self.request = request
+        self.upload_dir = upload_dir
+
+        # The form's text fields and its uploaded files (paths or contents), in the order they
+        # were sent
+        self.fields = {}
+        self.files = []
+
+        # The parser's callbacks are synchronous, so they only record what they parse. These
+        # events are then processed asynchronously once each received chunk has been parsed
+        self._events = []
+        self._header_field = b""
+        self._header_value = b""
+        self._content_disposition = b""
+
+    def _on_part_begin(self):
+        self._content_disposition = b""
+
+    def _on_header_field(self, data, start, end):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        if self._header_field.lower() == b"content-disposition":
+            self._content_disposition = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._content_disposition)
+        self._events.append(("part_begin", options))
+
+    def _on_part_data(self, data, start, end):
+        self._events.append(("part_data", data[start:end]))
+
+    def _on_part_end(self):
+        self._events.append(("part_end", None))
+
+    @staticmethod
+    async def _close_file(file, pending_write):
+        """Close an uploaded file once its last chunk has been written.
+
+        Args:
+            file (rapfiles.AsyncFile): The file to close.
+            pending_write (Optional[asyncio.Future]): The file's last write, if any.
+        """
+        try:
+            if pending_write is not None:
+                await pending_write
+        finally:
+            await file.close()
+
+    async def parse(self):
+        """Parse the request body, writing each uploaded file to disk chunk by chunk if needed.
+
+        Returns:
+            Tuple[Dict[str, str], Union[List[pathlib.Path], List[bytes]]]: The form's text fields
+                and the paths or the contents of the uploaded files, in the order they were sent.
+        """
+        content_type, params = parse_options_header(self.request.headers.get("content-type"))
+        if content_type != b"multipart/form-data" or b"boundary" not in params:
+            raise HTTPException(status_code=400, detail="Expected a multipart/form-data body.")
+
+        parser = MultipartParser(
+            params[b"boundary"],
+            callbacks={
+                "on_part_begin": self._on_part_begin,
+                "on_part_data": self._on_part_data,
+                "on_part_end": self._on_part_end,
+                "on_header_field": self._on_header_field,
+                "on_header_value": self._on_header_value,
+                "on_header_end": self._on_header_end,
+                "on_headers_finished": self._on_headers_finished,
+            },
+        )
+
+        name, is_file, chunks = None, False, []
+        file, pending_write, closing_files = None, None, []
+        try:
+            async for chunk in self.request.stream():
+                parser.write(chunk)
+
+                for event, data in self._events:
+                    if event == "part_begin":
+                        name = data.get(b"name", b"").decode()
+                        chunks = []
+
+                        # Parts with a file name are uploaded files, the others are text fields
+                        is_file = b"filename" in data
+                        if is_file and self.upload_dir is not None:
+                            path = self.upload_dir / f"upload_{len(self.files)}"
+                            file = await aiof.open(str(path), "wb")
+
+                    elif event == "part_data":
+                        if file is not None:
+                            # Write the chunk in the background while the next one is received,
+                            # only waiting for the previous write in order to keep chunks ordered
+                            if pending_write is not None:
+                                await pending_write
+                            pending_write = asyncio.ensure_future(file.write(data))
+                        else:
+                            chunks.append(data)
+
+                    elif file is not None:
+                        # Let the file's last write complete in the background, concurrently with
+                        # the writes of the next uploaded file. Files are only kept once complete
+                        closing_files.append(
+                            asyncio.ensure_future(self._close_file(file, pending_write))
+                        )
+                        file, pending_write = None, None
+                        self.files.append(path)
+
+                    elif is_file:
+                        self.files.append(b"".join(chunks))
+
+                    else:
+                        self.fields[name] = b"".join(chunks).decode()
+
+                self._events.clear()
+
+            parser.finalize()
+
+            # The parser does not check that the body ends with the closing boundary itself
+            if parser.state != MultipartState.END:
+                raise HTTPException(
+                    status_code=400, detail="Incomplete multipart/form-data body."
+                )
+
+        # Report malformed bodies, including text fields and names that are not valid UTF-8, the
+        # same way the regular form parsing does
+        except (MultipartParseError, UnicodeDecodeError) as error:
+            raise HTTPException(
+                status_code=400, detail="Malformed multipart/form-data body."
+            ) from error
+
+        finally:
+            if file is not None:
+                closing_files.append(asyncio.ensure_future(self._close_file(file, pending_write)))
+
+            # Wait for all the uploaded files to be completely written
+            results = await asyncio.gather(*closing_files, return_exceptions=True)
+
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+        return self.fields, self.files
+
+
+async def parse_fhe_form(request, form_model, upload_dir=None):
+    """Parse and validate the form's fields along with the uploaded files from a streamed form.
+
+    Args:
+        request (Request): The incoming request.
+        form_model (Type[FHERequest]): The model used for validating the form's fields.
+        upload_dir (Path): The directory where the uploaded files are written. If None, the
+            uploaded files are kept in memory instead. Default to None.
+
+    Returns:
+        Tuple[FHERequest, Union[List[pathlib.Path], List[bytes]]]: The validated form's fields and
+            the paths or the contents of the encrypted input image and the evaluation key.
+    """
+    fields, files = await StreamingFormParser(request, upload_dir).parse()
+
+    # Report invalid fields the same way FastAPI does for regular form parameters
+    try:
+        form = form_model.model_validate(fields)
+    except ValidationError as error:
+        raise RequestValidationError(
+            [{**e, "loc": ("body", *e["loc"])} for e in error.errors(include_url=False)]
+        ) from error
+
+    if len(files) != 2:
+        raise HTTPException(
+            status_code=422,
+            detail="Expected two uploaded files: the encrypted image and the evaluation key.",
+        )
+
+    return form, files
+
+
+def accepts_zstd(accept_encoding):
+    """Check whether the client accepts zstd-encoded responses.
+
+    Args:
+        accept_encoding (str): The request's Accept-Encoding header.
+
+    Returns:
+        bool: Whether zstd is one of the accepted encodings.
+    """
+    for encoding in accept_encoding.split(","):
+        coding, *params = encoding.split(";")
+        if coding.strip().lower() != "zstd":
+            continue
+
+        # A zero quality value means that the encoding is not acceptable
+        params = dict(param.strip().partition("=")[::2] for param in params)
+        try:
+            return float(params.get("q", 1)) > 0
+        except ValueError:
+            return False
+    return False
+
+
+class ZstdMiddleware:
+    """Compress the responses and decompress the requests using zstd.
+
+    Responses are compressed if the client accepts zstd, and zstd-encoded requests are decompressed
+    before they reach the endpoints. Encrypted data itself barely compresses while its serialization
+    does, so the first chunk of a response is compressed upfront: if it does not shrink, the whole
+    response is sent uncompressed.
+    """
+
+    def __init__(
+        self,
+        app,
+        level=ZSTD_LEVEL,
+        minimum_size=ZSTD_MINIMUM_SIZE,
+        max_decompressed_size=ZSTD_MAX_DECOMPRESSED_SIZE,
+    ):
+        """Initialize the middleware.
+
+        Args:
+            app (ASGIApp): The application to wrap.
+            level (int): The zstd compression level of the responses.
+            minimum_size (int): The size (in bytes) under which responses are sent uncompressed.
+            max_decompressed_size (int): The size (in bytes) above which decompressed requests are
+                rejected.
+        """
+        self.app = app
+        self.level = level
+        self.minimum_size = minimum_size
+        self.max_decompressed_size = max_decompressed_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+
+        if headers.get("content-encoding", "").strip().lower() == "zstd":
+            scope, receive = self.decompress_request(scope, receive)
+
+        if accepts_zstd(headers.get("accept-encoding", "")):
+            send = self.compress_response(send)
+
+        await self.app(scope, receive, send)
+
+    def decompress_request(self, scope, receive):
+        """Decompress a zstd-encoded request body as it is received.
+
+        The body is decompressed by slices small enough for their output not to exceed the
+        remaining allowed size, whatever they contain.
+
+        Args:
+            scope (dict): The request's scope.
+            receive (Callable): The function receiving the request's messages.
+
+        Returns:
+            Tuple[dict, Callable]: The scope, without the encoding and length headers of the
+                compressed body, and the function receiving the decompressed messages.
+        """
+        decompressor = zstandard.ZstdDecompressor(
+            max_window_size=ZSTD_MAX_WINDOW_SIZE
+        ).decompressobj()
+        remaining_size = self.max_decompressed_size
+        scope = dict(
+            scope,
+            headers=[
+                (name, value)
+                for name, value in scope["headers"]
+                if name not in (b"content-encoding", b"content-length")
+            ],
+        )
+
+        async def receive_decompressed():
+            nonlocal remaining_size
+
+            message = await receive()
+            if message["type"] != "http.request":
+                return message
+
+            compressed_body = memoryview(message.get("body", b""))
+            chunks = []
+            start = 0
+            while start < len(compressed_body):
+                # Small slices are slower to decompress, so they are only used close to the limit
+                end = start + min(64 * 1024, max(1024, remaining_size // ZSTD_MAX_RATIO))
+                try:
+                    chunk = decompressor.decompress(compressed_body[start:end])
+                except zstandard.ZstdError:
+                    raise HTTPException(status_code=400, detail="Invalid zstd-encoded body")
+
+                remaining_size -= len(chunk)
+                if remaining_size < 0:
+                    raise HTTPException(status_code=413, detail="Decompressed body too large")
+
+                chunks.append(chunk)
+                start = end
+
+            if not message.get("more_body", False) and not decompressor.eof:
+                raise HTTPException(status_code=400, detail="Incomplete zstd-encoded body")
+
+            return dict(message, body=b"".join(chunks))
+
+        return scope, receive_decompressed
+
+    def compress_response(self, send):
+        """Compress the response's body as it is sent, if it is worth it.
+
+        Args:
+            send (Callable): The function sending the response's messages.
+
+        Returns:
+            Callable: The function sending the compressed messages.
+        """
+        start_message = None
+        compressor = None
+
+        async def send_compressed(message):
+            nonlocal start_message, compressor
+
+            # Only the complete responses not encoded yet are compressed, and the start message is
+            # held back until the first chunk tells whether the response is worth compressing
+            if message["type"] == "http.response.start":
+                if message["status"] == 200 and "content-encoding" not in Headers(
+                    raw=message["headers"]
+                ):
+                    start_message = message
+                    return
+                compressor = False
+
+            if message["type"] != "http.response.body" or compressor is False:
+                # Other messages, such as the zero-copy http.response.pathsend of file responses,
+                # cannot be compressed, so the response is sent uncompressed
+                if start_message is not None and compressor is None:
+                    compressor = False
+                    await send(start_message)
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+            if compressor is not None:
+                body = compressor.compress(body)
+                if not more_body:
+                    body += compressor.flush()
+                if body or not more_body:
+                    await send(dict(message, body=body))
+                return
+
+            headers = MutableHeaders(raw=list(start_message["headers"]))
+            headers.add_vary_header("Accept-Encoding")
+
+            compressed_body = None
+            if more_body or len(body) >= self.minimum_size:
+                compressor = zstandard.ZstdCompressor(level=self.level).compressobj()
+                if more_body:
+                    compressed_body = compressor.compress(body) + compressor.flush(
+                        zstandard.COMPRESSOBJ_FLUSH_BLOCK
+                    )
+                else:
+                    # Complete bodies can be large, so they are compressed outside the event loop
+                    compressed_body = await asyncio.to_thread(
+                        lambda: compressor.compress(body) + compressor.flush()
+                    )
+
+            if compressed_body is None or len(compressed_body) >= len(body):
+                compressor = False
+                await send(dict(start_message, headers=headers.raw))
+                await send(message)
+                return
+
+            # The compressed representation differs from the uncompressed one, byte-wise
+            headers["Content-Encoding"] = "zstd"
+            if "etag" in headers and not headers["etag"].startswith("W/"):
+                headers["ETag"] = "W/" + headers["etag"]
+            if more_body:
+                del headers["Content-Length"]
+            else:
+                headers["Content-Length"] = str(len(compressed_body))
+
+            await send(dict(start_message, headers=headers.raw))
+            await send(dict(message, body=compressed_body))
+
+        return send_compressed
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """Start the worker processes executing FHE computations along with the server.
+
+    Each server process starts its own worker processes, which load the FHE servers once and for
+    all. Executing the CPU-bound FHE computations in separate processes lets concurrent requests
+    run in parallel instead of contending for the GIL.
+
+    The worker processes are started, and their FHE servers loaded, before the server accepts any
+    request so that the first requests do not pay for it.
+    """
+    global FHE_EXECUTOR, RUN_CACHE
+
+    make_private_dir(RUN_CACHE_PATH)
+    RUN_CACHE = diskcache.Cache(RUN_CACHE_PATH, size_limit=RUN_CACHE_SIZE)
+
+    EVICTION_MARKERS_PATH.mkdir(exist_ok=True)
+    eviction_task = asyncio.create_task(check_evictions())
+
+    prefetch_deployment_files()
+
+    FHE_EXECUTOR = create_fhe_executor()
+
+    # The executor only starts a new worker process when a task is submitted while no worker is
+    # idle, so submitting as many tasks as workers at once starts all of them
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(
+        *(loop.run_in_executor(FHE_EXECUTOR, get_worker_pid) for _ in range(FHE_WORKERS))
+    )
+
+    yield
+    eviction_task.cancel()
+    await FHE_BATCHER.close()
+    FHE_EXECUTOR.shutdown(cancel_futures=True)
+    SHARED_EVALUATION_KEYS.close()
+    RUN_CACHE.close()
+
+
 # Initialize an instance of FastAPI
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(ZstdMiddleware)
 
 # Define the default route
 @app.get("/")
@@ -36,144 +1134,207 @@ def root():
     return {"message": "Welcome to Image FHE Filter Server!"}
 
 @app.get("/available_filters")
-def get_available_filters():
-    return {"filters": AVAILABLE_FILTERS}
+async def get_available_filters(request: Request):
+    if is_not_modified(request, AVAILABLE_FILTERS_ETAG):
+        return Response(status_code=304, headers={"ETag": AVAILABLE_FILTERS_ETAG})
+
+    return JSONResponse(
+        content={"filters": AVAILABLE_FILTERS}, headers={"ETag": AVAILABLE_FILTERS_ETAG}
+    )
 
 
 @app.post("/send_input")
-def send_input(
-    user_id: str = Form(),
-    filter: str = Form(),
-    files: List[UploadFile] = File(),
-):
+async def send_input(request: Request):
     """Send the inputs to the server."""
-    # Retrieve the encrypted input image and the evaluation key paths
-    encrypted_image_path = get_server_file_path("encrypted_image", user_id, filter)
-    evaluation_key_path = get_server_file_path("evaluation_key", user_id, filter)
-    
-    # Write the files using the above paths
-    with encrypted_image_path.open("wb") as encrypted_image, evaluation_key_path.open(
-        "wb"
-    ) as evaluation_key:
-        encrypted_image.write(files[0].file.read())
-        evaluation_key.write(files[1].file.read())
+    # Stream the uploaded files to a scratch directory, as their final paths depend on the form's
+    # fields, which are only known once the whole body has been received
+    with tempfile.TemporaryDirectory(dir=SERVER_TMP_PATH) as upload_dir:
+        form, files = await parse_fhe_form(request, FHERequest, Path(upload_dir))
+        user_id, filter = form.user_id, form.filter
+
+        # Retrieve the encrypted input image and the evaluation key paths
+        encrypted_image_path = get_server_file_path("encrypted_image", user_id, filter)
+        evaluation_key_path = get_server_file_path("evaluation_key", user_id, filter)
+
+        # Move the files to the above paths
+        os.replace(files[0], encrypted_image_path)
+        os.replace(files[1], evaluation_key_path)
+
+    # Drop the previous evaluation key kept in memory, if any
+    EVALUATION_KEYS_CACHE.pop((user_id, filter), None)
 
 
 @app.post("/run_fhe")
-def run_fhe(
-    user_id: str = Form(),
-    filter: str = Form(),
-):
+async def run_fhe(form: Annotated[FHERequest, Form()]):
     """Execute the filter on the encrypted input image using FHE."""
-    # Retrieve the encrypted input image and the evaluation key paths
-    encrypted_image_path = get_server_file_path("encrypted_image", user_id, filter)
-    evaluation_key_path = get_server_file_path("evaluation_key", user_id, filter)
+    user_id, filter = form.user_id, form.filter
 
-    # Read the files using the above paths
-    with encrypted_image_path.open("rb") as encrypted_image_file, evaluation_key_path.open(
-        "rb"
-    ) as evaluation_key_file:
-        encrypted_image = encrypted_image_file.read()
-        evaluation_key = evaluation_key_file.read()
+    # Retrieve the encrypted input image path
+    encrypted_image_path = get_server_file_path("encrypted_image", user_id, filter)
 
-    # Load the FHE server related to the chosen filter
-    fhe_server = FHE_SERVERS[filter]
+    # Read the encrypted input image and load the evaluation key concurrently
+    encrypted_image, evaluation_key = await asyncio.gather(
+        aiof.read_file_bytes(str(encrypted_image_path)),
+        load_evaluation_key(user_id, filter),
+    )
 
-    # Run the FHE execution
-    start = time.time()
-    encrypted_output_image = fhe_server.run(encrypted_image, evaluation_key)
-    fhe_execution_time = round(time.time() - start, 2)
+    # Run the FHE execution, or retrieve its output if the same input was already processed
+    encrypted_output_image, fhe_execution_time = await execute_fhe(
+        user_id, filter, encrypted_image, evaluation_key
+    )
 
     # Retrieve the encrypted output image path
     encrypted_output_path = get_server_file_path("encrypted_output", user_id, filter)
 
     # Write the file using the above path
-    with encrypted_output_path.open("wb") as encrypted_output:
-        encrypted_output.write(encrypted_output_image)
+    await aiof.write_file_bytes(str(encrypted_output_path), encrypted_output_image)
 
     return JSONResponse(content=fhe_execution_time)
 
 
 @app.post("/get_output")
-def get_output(
-    user_id: str = Form(),
-    filter: str = Form(),
-):
+async def get_output(request: Request, form: Annotated[FHERequest, Form()]):
     """Retrieve the encrypted output image."""
+    user_id, filter = form.user_id, form.filter
+
     # Retrieve the encrypted output image path
     encrypted_output_path = get_server_file_path("encrypted_output", user_id, filter)
 
-    # Read the file using the above path
-    with encrypted_output_path.open("rb") as encrypted_output_file:
-        encrypted_output = encrypted_output_file.read()
+    if not encrypted_output_path.is_file():
+        raise HTTPException(status_code=404, detail="No encrypted output found.")
+
+    # The output only changes when a new computation replaces its file, so the file's version
+    # identifies it. The client can then skip downloading an output it already holds
+    etag = '"{:x}-{:x}"'.format(*get_file_version(encrypted_output_path))
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
 
-    return Response(encrypted_output)
+    # Send the file using the above path, without loading it in memory
+    return FileResponse(
+        encrypted_output_path, media_type="application/octet-stream", headers={"ETag": etag}
+    )
 
 
 @app.post("/fhe_full")
-def fhe_full(
-    user_id: str = Form(),
-    filter: str = Form(),
-    files: List[UploadFile] = File(),
-):
+async def fhe_full(request: Request):
     """Execute the complete FHE process: receive input, run FHE computation and return the result.
     Sequentially executes the business logic of /send_input, /run_fhe, and /get_output.
+
+    The inputs and the output are kept in memory. They are only written to disk, for later use by
+    /run_fhe and /get_output, if the form's `persist` field is set to true.
     """
-    # Step 1: Save the uploaded encrypted image and evaluation key (/send_input logic)
+    # Step 1: Receive the uploaded encrypted image and evaluation key (/send_input logic)
+    form, (encrypted_image, evaluation_key) = await parse_fhe_form(request, FHEFullRequest)
+    user_id, filter, persist = form.user_id, form.filter, form.persist
+    logger.debug("Encrypted image and evaluation key received")
+
+    # Retrieve the paths of the files written if the inputs and the output are persisted
     encrypted_image_path = get_server_file_path("encrypted_image", user_id, filter)
     evaluation_key_path = get_server_file_path("evaluation_key", user_id, filter)
-    
-    with encrypted_image_path.open("wb") as encrypted_image, evaluation_key_path.open(
-        "wb"
-    ) as evaluation_key:
-        encrypted_image.write(files[0].file.read())
-        evaluation_key.write(files[1].file.read())
-    print("Encrypted image and evaluation key saved")
-    
-    # Step 2: Execute FHE computation (/run_fhe logic)
-    with encrypted_image_path.open("rb") as encrypted_image_file, evaluation_key_path.open(
-        "rb"
-    ) as evaluation_key_file:
-        encrypted_image = encrypted_image_file.read()
-        evaluation_key = evaluation_key_file.read()
-
-    fhe_server = FHE_SERVERS[filter]
-    print("FHE server initialization completed")
-    start = time.time()
-    encrypted_output_image = fhe_server.run(encrypted_image, evaluation_key)
-    fhe_execution_time = round(time.time() - start, 2)
-    print("FHE computation completed")
-    
     encrypted_output_path = get_server_file_path("encrypted_output", user_id, filter)
-    
-    with encrypted_output_path.open("wb") as encrypted_output:
-        encrypted_output.write(encrypted_output_image)
-    print("Encrypted output image saved")
-    
-    # Step 3: Return the encrypted output result (/get_output logic)
-    with encrypted_output_path.open("rb") as encrypted_output_file:
-        encrypted_output = encrypted_output_file.read()
-    print("Returning encrypted output result completed")
-    
+
+    if persist:
+        # Write both files concurrently, as they are independent
+        await asyncio.gather(
+            aiof.write_file_bytes(str(encrypted_image_path), encrypted_image),
+            aiof.write_file_bytes(str(evaluation_key_path), evaluation_key),
+        )
+        cache_evaluation_key(
+            user_id, filter, evaluation_key, get_file_version(evaluation_key_path)
+        )
+        logger.debug("Encrypted image and evaluation key saved")
+
+    # Step 2: Execute FHE computation (/run_fhe logic)
+    encrypted_output_image, fhe_execution_time = await execute_fhe(
+        user_id, filter, encrypted_image, evaluation_key
+    )
+    logger.debug("FHE computation completed in %s seconds", fhe_execution_time)
+
+    if persist:
+        await aiof.write_file_bytes(str(encrypted_output_path), encrypted_output_image)
+        logger.debug("Encrypted output image saved")
+
+    # Step 3: Return the encrypted output result directly from memory (/get_output logic)
+    logger.debug("Returning encrypted output result")
+
     # Return FHE execution time information and encrypted output image
     return Response(
-        content=encrypted_output,
+        content=encrypted_output_image,
         headers={
             "X-FHE-Execution-Time": f"{fhe_execution_time}",
         }
     )
 
+@app.post("/evict_keys/{user_id}")
+async def evict_keys(user_id: UUID4):
+    """Remove all of the user's evaluation keys from the server's memory.
+
+    They are removed from the server process handling the request right away, and from the other
+    server processes within a few seconds. Only the filters evicted right away are returned.
+    """
+    evicted = [
+        filter for filter in AVAILABLE_FILTERS
+        if EVALUATION_KEYS_CACHE.pop((user_id, filter), None) is not None
+    ]
+
+    # Let the other server processes know about the eviction, touching the marker again if the
+    # user's keys were already evicted before. The eviction still applies to this server process if
+    # the marker cannot be written
+    try:
+        EVICTION_MARKERS_PATH.mkdir(exist_ok=True)
+        (EVICTION_MARKERS_PATH / str(user_id)).touch()
+    except OSError:
+        logger.exception("Failed to let the other server processes evict the evaluation keys")
+
+    return {"evicted": evicted}
+
 @app.get("/test/image/{image_name}")
-def test_image(image_name: str):
+async def test_image(image_name: str):
     """Just for testing the image."""
     image_path = CLIENT_TMP_PATH / image_name
-    with open(image_path, "rb") as image_file:
-        image_data = image_file.read()
-    return Response(content=image_data, media_type="image/jpeg")
+
+    if not image_path.is_file():
+        raise HTTPException(status_code=404, detail="Image not found.")
+
+    return FileResponse(image_path, media_type="image/jpeg")
 
 # Start the server when this script is run directly
 if __name__ == "__main__":
+    import copy
+
     import uvicorn
+    from uvicorn.config import LOGGING_CONFIG
+
     print("Starting FHE server...")
     print("Server address: http://localhost:8000")
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+
+    # Start one server process per CPU by default. The server processes import this module again,
+    # so they read their number from the environment
+    os.environ.setdefault("FHE_SERVER_WORKERS", str(os.cpu_count()))
+    server_workers = int(os.environ["FHE_SERVER_WORKERS"])
+
+    # Optional tuning knobs: the maximum number of concurrent connections before answering with
+    # 503 errors, and the maximum number of connections waiting to be accepted
+    limit_concurrency = os.environ.get("FHE_LIMIT_CONCURRENCY")
+    backlog = int(os.environ.get("FHE_BACKLOG", 2048))
+
+    # Route the server's own logs through Uvicorn's handler. Set FHE_LOG_LEVEL to "DEBUG" to trace
+    # each step of the requests, which are otherwise skipped at no cost
+    log_config = copy.deepcopy(LOGGING_CONFIG)
+    log_config["loggers"]["fhe_server"] = {
+        "handlers": ["default"],
+        "level": os.environ.get("FHE_LOG_LEVEL", "INFO").upper(),
+    }
+
+    uvicorn.run(
+        "fhe_server:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=server_workers,
+        loop="uvloop",
+        http="httptools",
+        limit_concurrency=int(limit_concurrency) if limit_concurrency else None,
+        backlog=backlog,
+        log_config=log_config,
+        log_level="warning",
+    )
@@ -1,16 +1,21 @@
 # server.py
 from mcp.server.fastmcp import FastMCP, Image as MCPImage
+import functools
 import os
 import tempfile
 import uuid
 import shutil
 from pathlib import Path
 import requests
+from cachetools import TTLCache, cached
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
 import base64
 from io import BytesIO
 from PIL import Image
 import numpy
 import urllib.parse
+import zstandard
 
 import json
 
@@ -21,21 +26,73 @@ from common import FILTERS_PATH, KEYS_PATH, CLIENT_TMP_PATH
 FHE_SERVER_URL = "http://localhost:8000"
 # Set HTTP request timeout to 5 minutes
 HTTP_TIMEOUT = 300
+# Keep the list of available filters for 1 minute before fetching it again
+AVAILABLE_FILTERS_TTL = 60
+# Compress the uploaded data with zstd at a low level, so that compressing it stays cheap
+ZSTD_LEVEL = 1
+# Size (in bytes) of the first part of each uploaded file compressed to tell whether it shrinks
+ZSTD_SAMPLE_SIZE = 64 * 1024
+
+# Share a connection pool across all HTTP requests, instead of opening a new connection each time
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=64))
+SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=64))
 
 # Create an MCP server
 mcp = FastMCP("FHE-MCP-Server")
 
 def download_image(image_url: str) -> str:
     """Download image from image_url and save to local storage"""
-    response = requests.get(image_url, timeout=HTTP_TIMEOUT)
+    response = SESSION.get(image_url, timeout=HTTP_TIMEOUT)
     image_path = f"{CLIENT_TMP_PATH}/{uuid.uuid4()}.jpg"
     with open(image_path, "wb") as f:
         f.write(response.content)
     return image_path
 
+def read_response_content(response):
+    """Read a streamed response's content, decompressing it if the server compressed it with zstd.
+
+    Args:
+        response (requests.Response): The response, requested with `stream=True`.
+
+    Returns:
+        bytes: The response's content.
+    """
+    if response.headers.get("Content-Encoding") != "zstd":
+        return response.content
+
+    # Read the raw content as it is received, which also releases the connection once done
+    decompressor = zstandard.ZstdDecompressor().decompressobj()
+    return b"".join(
+        decompressor.decompress(chunk)
+        for chunk in response.raw.stream(1024**2, decode_content=False)
+    )
+
+def is_worth_compressing(*files):
+    """Tell whether uploaded files shrink when compressed with zstd, from their first bytes.
+
+    Encrypted data is mostly random and often does not shrink, in which case compressing it would
+    only cost time.
+
+    Args:
+        *files (bytes): The files to upload.
+
+    Returns:
+        bool: Whether the sample of any of the files shrinks when compressed.
+    """
+    compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+    for data in files:
+        sample = memoryview(data)[:ZSTD_SAMPLE_SIZE]
+        if len(compressor.compress(sample)) < len(sample):
+            return True
+    return False
+
+@functools.lru_cache(maxsize=4096)
 def get_client_file_path(name, id, filter_name):
     """Get the correct temporary file path for the client.
 
+    The paths are cached, as the same ones are computed when saving and decrypting an output.
+
     Args:
         name (str): The desired file name.
         id (str): The unique identifier for the file.
@@ -47,12 +104,19 @@ def get_client_file_path(name, id, filter_name):
     return CLIENT_TMP_PATH / f"{name}_{filter_name}_{id}"
 
 
+@cached(TTLCache(maxsize=1, ttl=AVAILABLE_FILTERS_TTL))
+def fetch_available_filters():
+    """Fetch the list of available FHE image filters from the FHE server, caching it briefly"""
+    response = SESSION.get(f"{FHE_SERVER_URL}/available_filters", timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+
 # FHE toolkit
 @mcp.tool()
 def get_available_filters() -> dict:
     """Get list of available FHE image filters"""
-    response = requests.get(f"{FHE_SERVER_URL}/available_filters", timeout=HTTP_TIMEOUT)
-    return response.json()
+    return fetch_available_filters()
 
 @mcp.tool()
 def process_image_with_fhe(
@@ -88,34 +152,45 @@ def process_image_with_fhe(
     # Resize to 100x100 as required by the model
     if input_image.size != (100, 100):
         input_image = input_image.resize((100, 100))
-    # Convert to numpy array for FHE processing
-    input_image_array = numpy.array(input_image)
+    # Convert to numpy array for FHE processing, without an extra copy of the array
+    input_image_array = numpy.asarray(input_image, dtype=numpy.uint8)
     # Ensure it's uint8 type, 3 channels (RGB)
     assert input_image_array.shape == (100, 100, 3), f"Incorrect image shape: {input_image_array.shape}"
     encrypt_result = client.encrypt_serialize(input_image_array)
+    evaluation_keys = client.get_serialized_evaluation_keys()
     
-    # 3. Prepare request data
-    files = [
-        ('files', ('encrypted_image.bin', encrypt_result, 'application/octet-stream')),
-        ('files', ('evaluation_keys.bin', client.get_serialized_evaluation_keys(), 'application/octet-stream'))
-    ]
-    data = {
-        "user_id": user_id,
-        "filter": filter_name
-    }
-
-    
-    # 4. Execute complete FHE process in one step (replaces the original three requests)
-    response = requests.post(
+    # 3. Prepare request data, streamed by chunks instead of being copied into a single request
+    # body. Wrapping the serialized data in BytesIO objects does not copy them either
+    encoder = MultipartEncoder(fields=[
+        ('user_id', user_id),
+        ('filter', filter_name),
+        ('files', ('encrypted_image.bin', BytesIO(encrypt_result), 'application/octet-stream')),
+        ('files', (
+            'evaluation_keys.bin',
+            BytesIO(evaluation_keys),
+            'application/octet-stream',
+        )),
+    ])
+
+    # 4. Execute complete FHE process in one step (replaces the original three requests). The
+    # request body is compressed with zstd as it is streamed if it is worth it, and so may be the
+    # response
+    headers = {"Content-Type": encoder.content_type, "Accept-Encoding": "zstd"}
+    data = encoder
+    if is_worth_compressing(encrypt_result, evaluation_keys):
+        headers["Content-Encoding"] = "zstd"
+        data = zstandard.ZstdCompressor(level=ZSTD_LEVEL).read_to_iter(encoder)
+    response = SESSION.post(
         f"{FHE_SERVER_URL}/fhe_full", 
-        data=data, 
-        files=files, 
-        timeout=HTTP_TIMEOUT
+        data=data,
+        headers=headers,
+        timeout=HTTP_TIMEOUT,
+        stream=True,
     )
     
     # 5. Get execution time and encrypted output from response
     execution_time = float(response.headers.get("X-FHE-Execution-Time", 0))
-    encrypted_output = response.content
+    encrypted_output = read_response_content(response)
 
     # 6. Save encrypted output data directly, without decryption
     output_id = str(uuid.uuid4())
@@ -140,7 +215,7 @@ def decrypt_output_image(user_id: str, filter_name: str, output_id: str) -> str:
         filter_name: Filter name
         output_id: Output ID
     Returns:
-        str: URL of the decrypted image
+        str: The decrypted image, as a PNG data URI
     """
     # URL decode filter_name, handle possible spaces and special characters
     decoded_filter_name = urllib.parse.unquote(filter_name)
@@ -162,20 +237,18 @@ def decrypt_output_image(user_id: str, filter_name: str, output_id: str) -> str:
     decrypted_output = client.deserialize_decrypt_post_process(encrypted_output)
 
     if isinstance(decrypted_output, bytes):
-        # If it's bytes type, need to convert to numpy array
-        decrypted_output_array = numpy.frombuffer(decrypted_output, dtype=numpy.uint8).reshape(100, 100, 3)
+        # If it's bytes type, create the PIL image directly from the raw RGB bytes
+        pil_image = Image.frombuffer("RGB", (100, 100), decrypted_output, "raw", "RGB", 0, 1)
     else:
-        # If it's already a numpy array but not uint8 type, need to convert
-        decrypted_output_array = numpy.array(decrypted_output, dtype=numpy.uint8)
-        
-    # Create PIL image using the converted array
-    pil_image = Image.fromarray(decrypted_output_array)
-    image_uuid = str(uuid.uuid4())
-    # Save as temporary JPG file
-    temp_jpg_path = get_client_file_path(f"temp_jpg_{image_uuid}", f"{user_id}.jpeg", decoded_filter_name)
-    pil_image.save(temp_jpg_path, format="JPEG")
-    
-    # Return Test image URL string
-    image_filename = temp_jpg_path.name
-    return f"{FHE_SERVER_URL}/test/image/{image_filename}"
-    # return MCPImage(path=temp_jpg_path)
+        # If it's already a numpy array but not uint8 type, need to convert (no copy is made if it
+        # already is), then create the PIL image using the converted array
+        pil_image = Image.fromarray(numpy.asarray(decrypted_output, dtype=numpy.uint8))
+
+    # Encode the image in memory as a PNG, which is lossless and, with a low compression level,
+    # faster to encode than a JPEG at this size. This avoids writing it to disk and fetching it back
+    # through the server
+    buffer = BytesIO()
+    pil_image.save(buffer, format="PNG", compress_level=1)
+
+    # Return the image as a data URI string
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode()